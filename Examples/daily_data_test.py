@@ -17,6 +17,8 @@ for index, row in sites.iterrows():
         # If Daily Discharge is available, extract data for that site ID, otherwise skip it
         if 'Discharge Daily' in list(p['attributes.ParameterLabel'] + ' ' + p['attributes.ComputationPeriod']):
             location = GetSite(row['attributes.LocationCode'], timestep='daily', dataset='QR', start='1900-01-01', end='2024-05-08')
+            # Each sensor comes back sorted and de-duplicated, but a site can have several daily sensors
+            # (e.g. Mean and Max) on the same date, so keep one row per date
             data = location.data.sort_values(by='Date')
             data.drop_duplicates(subset='Date', inplace=True)
             site_data.append(data[['Date', 'RecordedValue', 'SiteID']])
@@ -11,6 +11,7 @@ To do:
     * Add plotting functionality
 """
 
+import warnings
 import requests
 import pandas as pd
 from tzlocal import get_localzone
@@ -65,6 +66,15 @@ TIMESERIES_FIELDS = [
 
 AVAILABLE_DATASETS = ['QR', 'HG', 'TW', 'Wat_LVL_BLSD', 'Lake_Elev_NGVD', 'LS']
 
+# Upper bound on resultOffset pages fetched for a single sensor query
+MAX_TIMESERIES_PAGES = 500
+
+# Look-back (last, units) used when no start/end is supplied, keyed by timestep and notime_return
+NOTIME_LOOKBACK = {
+    'instant': {'recent': (2, 'H'), '7D': (7, 'D'), '30D': (30, 'D')},
+    'daily': {'recent': (2, 'D'), '7D': (7, 'D'), '30D': (30, 'D')}
+}
+
 
 def site_list():
     status_type = ['Real-Time', 'Seasonal', 'FWP', 'Discontinued', 'Reservoir']
@@ -134,9 +144,18 @@ class GetSite(object):
         a string representing the station ID(s) of interest (only 1 site functional as of this version)
     timestep : str
         specify either 'instant' for instantaneous data or 'daily' for average daily values; default is 'instant'
+    merge_keep : str
+        rule for rows returned more than once for the same timestamp, one of utilities.MERGE_RULES; 'approval' keeps
+        the highest ApprovalLevel, 'newest'/'oldest' keep the row from the last/first sensor queried; default is
+        'approval'
+    combine_sensors : bool
+        if True, sensors with the same DatasetLabel are merged into one series by merge_keep; otherwise each sensor is
+        only de-duplicated against its own pages; default is False
     """
     def __init__(self, site_id, timestep='instant', dataset=None, start=None, end=None, notime_return='recent',
-                 inst_only_method='end_day'):
+                 inst_only_method='end_day', merge_keep='approval', combine_sensors=False):
+        if merge_keep not in utilities.MERGE_RULES:
+            raise ValueError("merge_keep must be one of {0}, not {1!r}".format(utilities.MERGE_RULES, merge_keep))
         self._site = site_id
         self._data_timestep = timestep
         self._dset = dataset
@@ -144,6 +163,8 @@ class GetSite(object):
         self._queryend = end
         self._nt_return = notime_return
         self._instonly_method = inst_only_method
+        self._merge_keep = merge_keep
+        self._combine_sensors = combine_sensors
         self._location_info = self._get_location_info()
 
         self.site_info = self._format_site_info()
@@ -281,13 +302,14 @@ class GetSite(object):
                 else:
                     print("Dataset argument is neither list nor string.")
 
-        TSdata_lst = []
+        sensor_data = {}
         for i, snsr in enumerate(sensor_lst):
             # Need to add logic for dealing with dates for each get request
             # Also need to separate instant only datasets and calculate end of day values
             time_qry = self._format_time_inputs()
             payload = {'where': "SensorID='{0}'".format(snsr),
                             'outFields': ','.join(TIMESERIES_FIELDS),
+                            'orderByFields': 'Timestamp',
                             'f': FORMAT
                        }
             # Need to change/update, should never have time_qry = None
@@ -300,45 +322,46 @@ class GetSite(object):
             else:
                 payload.update(time_qry)
 
-            response = requests.get(TIMESERIES_URL, params=payload)
-            rjson = response.json()
-            new_feat = [d['attributes'] for d in rjson['features']]
-            DF = pd.DataFrame(new_feat)
+            # Pages of one ordered query form a single run; the repeated fall-back hour is told apart on true UTC
+            DF = pd.concat(self._query_timeseries(payload), ignore_index=True)
+            DF['UtcTimestamp'] = utilities.stage_ms_to_unix(DF['Timestamp'].to_numpy(), ambiguous='infer')
             DF['SiteID'] = sites[i]
             DF['DatasetCode'] = paramCodes[i]
             DF['DatasetLabel'] = data_labels[i]
+            # Each sensor is merged on its own unless combine_sensors asks for sensors sharing a label to be joined
+            group = data_labels[i] if self._combine_sensors else snsr
+            sensor_data.setdefault(group, (paramCodes[i], []))[1].append(DF)
 
+        TSdata_lst = []
+        for code, chunks in sensor_data.values():
+            DF = utilities.merge_timeseries(chunks, key='UtcTimestamp', keep=self._merge_keep)
             if self._data_timestep == 'instant':
-                TSunxdts = (DF['Timestamp'] / 1000)
-                TSdts = pd.to_datetime(TSunxdts, unit='s')
+                TSdts = pd.to_datetime(DF['UtcTimestamp'].to_numpy(), unit='ms', utc=True)
                 dtind = pd.DatetimeIndex(TSdts)
-                dts_local = dtind.tz_localize('US/Mountain')
-                fn_dts = dts_local.tz_convert(get_localzone())
+                fn_dts = dtind.tz_convert(get_localzone())
                 #fn_dts.rename('Datetime', inplace=True)
                 #DF.set_index(fn_dts, inplace=True)
                 DF['Datetime'] = fn_dts
-                DF.drop('Timestamp', axis=1, inplace=True)
-            elif self._data_timestep == 'daily' and paramCodes[i] in INST_ONLY:
-                TSunxdts = (DF['Timestamp'] / 1000)
-                TSdts = pd.to_datetime(TSunxdts, unit='s')
+                DF.drop(['Timestamp', 'UtcTimestamp'], axis=1, inplace=True)
+            elif self._data_timestep == 'daily' and code in INST_ONLY:
+                TSdts = pd.to_datetime(DF['UtcTimestamp'].to_numpy(), unit='ms', utc=True)
                 dtind = pd.DatetimeIndex(TSdts)
-                dts_local = dtind.tz_localize('US/Mountain')
-                fn_dts = dts_local.tz_convert(get_localzone())
+                fn_dts = dtind.tz_convert(get_localzone())
                 fn_dts.rename('Datetime', inplace=True)
                 DF.set_index(fn_dts, inplace=True)
                 DF = DF.resample('1D').last()
                 DF['Date'] = DF.index.strftime('%Y-%m-%d')
                 DF.reset_index(inplace=True)
-                DF.drop('Timestamp', axis=1, inplace=True)
+                DF.drop(['Timestamp', 'UtcTimestamp'], axis=1, inplace=True)
                 DF.drop('Datetime', axis=1, inplace=True)
-            elif self._data_timestep == 'daily' and paramCodes[i] not in INST_ONLY:
+            elif self._data_timestep == 'daily' and code not in INST_ONLY:
                 TSdts = pd.to_datetime(DF['Timestamp'], unit='ms')
                 dtind = pd.DatetimeIndex(TSdts)
                 fn_dts = dtind.strftime('%Y-%m-%d')
                 #fn_dts.rename('Date', inplace=True)
                 #TSdata.set_index(fn_dts, inplace=True)
                 DF['Date'] = fn_dts
-                DF.drop('Timestamp', axis=1, inplace=True)
+                DF.drop(['Timestamp', 'UtcTimestamp'], axis=1, inplace=True)
             else:
                 print("Timestamps could not be re-formatted.")
                 pass
@@ -352,6 +375,31 @@ class GetSite(object):
 
         return TSdata
 
+    def _query_timeseries(self, payload):
+        # Page through the server's transfer limit; each page comes back sorted by Timestamp
+        chunks = []
+        offset = 0
+        prev_feat = None
+        for _ in range(MAX_TIMESERIES_PAGES):
+            response = requests.get(TIMESERIES_URL, params=dict(payload, resultOffset=offset))
+            rjson = response.json()
+            new_feat = [d['attributes'] for d in rjson['features']]
+            # A layer without resultOffset support hands back the same first page again
+            if prev_feat and new_feat and (new_feat[0]['Timestamp'] < prev_feat[-1]['Timestamp']
+                                           or new_feat[0] == prev_feat[0]):
+                warnings.warn("Sensor query for {0} did not advance past offset {1}; the server may not support "
+                              "paging and results are truncated.".format(payload['where'], offset))
+                break
+            chunks.append(pd.DataFrame(new_feat))
+            offset += len(new_feat)
+            if not rjson.get('exceededTransferLimit') or not new_feat:
+                break
+            prev_feat = new_feat
+        else:
+            warnings.warn("Sensor query for {0} stopped after {1} pages; results are truncated.".format(
+                payload['where'], MAX_TIMESERIES_PAGES))
+        return chunks
+
     # no empty time queries, need to explicitly identify start and end times
     # need to provide subsetting date ranges for instant values in case user needs more than 10000 values paginated
     # (multiple time queries)
@@ -359,78 +407,24 @@ class GetSite(object):
     # if no start/end provided, default behavior can be set when instantiating the class --
     # return latest value, previous 7-days, or previous 30-days
     def _format_time_inputs(self):
-        # TODO - Check validity of start, end strings, currently only checks that it is not None
-        if self._data_timestep == 'instant':
-            if self._querystart is None and self._queryend is None:
-                if self._nt_return == 'recent':
-                    strt, end = utilities.get_previous_timerange()
-                    strt = int(utilities.offset_unix(strt) * 1000)
-                    end = int(utilities.offset_unix(end) * 1000)
-                    time_qry = {'time': '{0}, {1}'.format(strt, end)}
-                elif self._nt_return == '7D':
-                    strt, end = utilities.get_previous_timerange(last=7, units='D')
-                    strt = int(utilities.offset_unix(strt) * 1000)
-                    end = int(utilities.offset_unix(end) * 1000)
-                    time_qry = {'time': '{0}, {1}'.format(strt, end)}
-                elif self._nt_return == '30D':
-                    strt, end = utilities.get_previous_timerange(last=30, units='D')
-                    strt = int(utilities.offset_unix(strt) * 1000)
-                    end = int(utilities.offset_unix(end) * 1000)
-                    time_qry = {'time': '{0}, {1}'.format(strt, end)}
-                else:
-                    print("No time query supplied and an invalid response was entered for notime_return behavior.")
-                    print("Using most recent reading as default.")
-                    strt, end = utilities.get_previous_timerange()
-                    strt = int(utilities.offset_unix(strt) * 1000)
-                    end = int(utilities.offset_unix(end) * 1000)
-                    time_qry = {'time': '{0}, {1}'.format(strt, end)}
-            elif self._querystart is None and self._queryend is not None:
-                strt = 'null'
-                end = int((utilities.offset_unix(utilities.datetime_to_unix(self._queryend)))*1000)
-                time_qry = {'time': '{0}, {1}'.format(strt, end)}
-            elif self._querystart is not None and self._queryend is None:
-                strt = int((utilities.offset_unix(utilities.datetime_to_unix(self._querystart)))*1000)
-                end = 'null'
-                time_qry = {'time': '{0}, {1}'.format(strt, end)}
-            else:
-                strt = int((utilities.offset_unix(utilities.datetime_to_unix(self._querystart)))*1000)
-                end = int((utilities.offset_unix(utilities.datetime_to_unix(self._queryend)))*1000)
-                time_qry = {'time': '{0}, {1}'.format(strt, end)}
-        elif self._data_timestep == 'daily':
-            if self._querystart is None and self._queryend is None:
-                if self._nt_return == 'recent':
-                    strt, end = utilities.get_previous_timerange(last=2, units='D', unix=False)
-                    strt = int(utilities.date_to_unix_naive(strt.strftime("%Y-%m-%d")) * 1000)
-                    end = int(utilities.date_to_unix_naive(end.strftime("%Y-%m-%d")) * 1000)
-                    time_qry = {'time': '{0}, {1}'.format(strt, end)}
-                elif self._nt_return == '7D':
-                    strt, end = utilities.get_previous_timerange(last=7, units='D', unix=False)
-                    strt = int(utilities.date_to_unix_naive(strt.strftime("%Y-%m-%d")) * 1000)
-                    end = int(utilities.date_to_unix_naive(end.strftime("%Y-%m-%d")) * 1000)
-                    time_qry = {'time': '{0}, {1}'.format(strt, end)}
-                elif self._nt_return == '30D':
-                    strt, end = utilities.get_previous_timerange(last=30, units='D', unix=False)
-                    strt = int(utilities.date_to_unix_naive(strt.strftime("%Y-%m-%d")) * 1000)
-                    end = int(utilities.date_to_unix_naive(end.strftime("%Y-%m-%d")) * 1000)
-                    time_qry = {'time': '{0}, {1}'.format(strt, end)}
-                else:
-                    print("No time query supplied and an invalid response was entered for notime_return behavior.")
-                    print("Using most recent reading as default.")
-                    strt, end = utilities.get_previous_timerange(last=2, units='D', unix=False)
-                    strt = int(utilities.date_to_unix_naive(strt.strftime("%Y-%m-%d")) * 1000)
-                    end = int(utilities.date_to_unix_naive(end.strftime("%Y-%m-%d")) * 1000)
-                    time_qry = {'time': '{0}, {1}'.format(strt, end)}
-            elif self._querystart is None and self._queryend is not None:
-                strt = 'null'
-                end = int(utilities.date_to_unix_naive(self._queryend)*1000)
-                time_qry = {'time': '{0}, {1}'.format(strt, end)}
-            elif self._querystart is not None and self._queryend is None:
-                strt = int(utilities.date_to_unix_naive(self._querystart)*1000)
-                end = 'null'
-                time_qry = {'time': '{0}, {1}'.format(strt, end)}
+        # Start and end must be "YYYY-mm-dd"; dates_to_stage_ms raises ValueError for malformed or missing dates
+        time_qry = None
+        if self._querystart is None and self._queryend is None and self._data_timestep in NOTIME_LOOKBACK:
+            lookback = NOTIME_LOOKBACK[self._data_timestep]
+            if self._nt_return not in lookback:
+                print("No time query supplied and an invalid response was entered for notime_return behavior.")
+                print("Using most recent reading as default.")
+            last, units = lookback.get(self._nt_return, lookback['recent'])
+            if self._data_timestep == 'instant':
+                strt, end = utilities.unix_to_stage_ms(utilities.get_previous_timerange(last=last, units=units))
             else:
-                strt = int(utilities.date_to_unix_naive(self._querystart)*1000)
-                end = int(utilities.date_to_unix_naive(self._queryend)*1000)
-                time_qry = {'time': '{0}, {1}'.format(strt, end)}
+                bounds = utilities.get_previous_timerange(last=last, units=units, unix=False)
+                strt, end = utilities.dates_to_stage_ms([b.strftime("%Y-%m-%d") for b in bounds])
+            time_qry = {'time': '{0}, {1}'.format(strt, end)}
+        elif self._data_timestep in NOTIME_LOOKBACK:
+            # Query dates are Mountain wall-clock dates for both timesteps
+            strt, end = ['null' if d is None else utilities.dates_to_stage_ms(d)
+                         for d in (self._querystart, self._queryend)]
+            time_qry = {'time': '{0}, {1}'.format(strt, end)}
 
         return time_qry
@@ -3,42 +3,171 @@ Utility functions used by stage.py
 """
 
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+import numpy as np
+import pandas as pd
 import pytz
 
 stage_tz = 'US/Mountain'
 
+# pytz only tabulates transitions through 2037; later years are filled in from the current US rule
+# (2nd Sunday of March to 1st Sunday of November, switching at 02:00 local time).
+TRANSITION_TABLE_END_YEAR = 2100
+
+_EPOCH = datetime(1970, 1, 1)
+_MS = timedelta(milliseconds=1)
+_TABLE_END_MS = (datetime(TRANSITION_TABLE_END_YEAR + 1, 1, 1) - _EPOCH) // _MS
+_UNIT_MS = {'S': 1000, 'MS': 1}
+AMBIGUOUS_RULES = ['earliest', 'latest', 'infer']
+
+
+@lru_cache(maxsize=None)
+def _stage_transitions():
+    """
+    Builds the UTC-offset transition table for the StAGE timezone once per session.
+    :return: tuple of int64 arrays (UTC transition times in epoch ms, UTC offset in ms from each transition on,
+        wall-clock time in StAGE ms at which each offset starts)
+    """
+    tz = pytz.timezone(stage_tz)
+    # pytz has no public transition list; its private tables are read on purpose so results match what pytz's own
+    # localize/astimezone (and the old scalar offset_unix) return
+    utc_ms = [(t - _EPOCH) // _MS for t in tz._utc_transition_times]
+    off_ms = [info[0] // _MS for info in tz._transition_info]
+    std_ms = tz._transition_info[-1][0] // _MS
+    last_year = tz._utc_transition_times[-1].year
+    for yr in range(last_year + 1, TRANSITION_TABLE_END_YEAR + 1):
+        march_first = datetime(yr, 3, 1)
+        nov_first = datetime(yr, 11, 1)
+        dst_start = march_first + timedelta(days=(6 - march_first.weekday()) % 7 + 7, hours=2)
+        dst_end = nov_first + timedelta(days=(6 - nov_first.weekday()) % 7, hours=2)
+        utc_ms.append((dst_start - _EPOCH) // _MS - std_ms)
+        off_ms.append(std_ms + 3600000)
+        utc_ms.append((dst_end - _EPOCH) // _MS - std_ms - 3600000)
+        off_ms.append(std_ms)
+    utc_ms = np.array(utc_ms, dtype=np.int64)
+    off_ms = np.array(off_ms, dtype=np.int64)
+    wall_ms = utc_ms + off_ms
+    for arr in (utc_ms, off_ms, wall_ms):
+        arr.setflags(write=False)
+    return utc_ms, off_ms, wall_ms
+
+
+def dates_to_stage_ms(dates):
+    """
+    Converts dates or datetimes on the StAGE (Mountain) wall clock to StAGE timestamps. StAGE stores local wall-clock
+    time as if it were UTC, so no DST lookup is needed and dates before 1970 simply give negative values.
+    :param dates: "YYYY-mm-dd" string, datetime, or array-like of either; naive datetimes are read as Mountain wall
+        clock, timezone-aware datetimes are converted to Mountain first
+    :return: numpy int64 array (or scalar for scalar input) of milliseconds from Epoch
+    :raises ValueError: if a string does not match "YYYY-mm-dd" or a value is missing
+    """
+    arr = np.asarray(dates)
+    flat = arr.ravel()
+    if arr.dtype.kind in 'US' or (arr.dtype == object and all(isinstance(d, str) for d in flat)):
+        wall = pd.to_datetime(flat.astype(str), format='%Y-%m-%d')
+    elif arr.dtype == object:
+        wall = pd.to_datetime([_to_stage_wall_clock(d) for d in flat])
+    else:
+        wall = pd.to_datetime(flat)
+    if wall.tz is not None:
+        wall = wall.tz_convert(stage_tz).tz_localize(None)
+    if wall.isna().any():
+        raise ValueError("Missing date in {0!r}".format(dates))
+    stage_ms = wall.to_numpy(dtype='datetime64[ms]').astype(np.int64).reshape(arr.shape)
+    return stage_ms[()]
+
+
+def _to_stage_wall_clock(value):
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(pytz.timezone(stage_tz)).replace(tzinfo=None)
+    return value
+
+
+def stage_ms_to_dates(stage_ms):
+    """
+    Converts StAGE timestamps back to naive Mountain wall-clock datetimes.
+    :param stage_ms: int or array-like of StAGE milliseconds from Epoch
+    :return: numpy datetime64[ms] array (or scalar for scalar input)
+    """
+    return np.asarray(stage_ms, dtype=np.int64).astype('datetime64[ms]')[()]
+
+
+def _check_table_range(ms):
+    if np.any(ms >= _TABLE_END_MS):
+        raise ValueError("Timestamps after {0} are outside the DST transition table "
+                         "(TRANSITION_TABLE_END_YEAR)".format(TRANSITION_TABLE_END_YEAR))
+
+
+def unix_to_stage_ms(timestamps, units='S'):
+    """
+    Vectorized equivalent of offset_unix(); shifts true UTC UNIX timestamps onto the StAGE (Mountain) wall clock using
+    the DST transition in effect at each instant.
+    :param timestamps: int, float or array-like of UNIX timestamps
+    :param units: 'S' for seconds or 'MS' for milliseconds; default is 'S'
+    :return: numpy int64 array (or scalar for scalar input) of StAGE milliseconds from Epoch
+    :raises ValueError: if a timestamp falls after TRANSITION_TABLE_END_YEAR
+    """
+    utc_ms = np.round(np.asarray(timestamps, dtype=np.float64) * _UNIT_MS[units]).astype(np.int64)
+    _check_table_range(utc_ms)
+    trans_ms, off_ms, _ = _stage_transitions()
+    idx = np.searchsorted(trans_ms, utc_ms, side='right') - 1
+    stage_ms = utc_ms + off_ms[np.clip(idx, 0, None)]
+    return stage_ms[()]
+
+
+def stage_ms_to_unix(stage_ms, ambiguous='earliest'):
+    """
+    Converts StAGE timestamps (Mountain wall clock) to true UTC UNIX milliseconds.
+
+    Wall-clock times repeated by the fall-back transition resolve to the first (MDT) occurrence when ambiguous is
+    'earliest' or the second (MST) occurrence when it is 'latest'. With 'infer' the input is taken to be in time order
+    (as StAGE returns it with orderByFields=Timestamp): a repeated-hour time goes to MST once an earlier row in that hour
+    has the same or a later wall-clock time, otherwise to MDT. Wall-clock times skipped by the spring-forward
+    transition are read with the standard-time offset, i.e. they land just after the transition.
+    :param stage_ms: int or array-like of StAGE milliseconds from Epoch
+    :param ambiguous: 'earliest', 'latest' or 'infer'; default is 'earliest'
+    :return: numpy int64 array (or scalar for scalar input) of UNIX milliseconds from Epoch
+    :raises ValueError: if a timestamp falls after TRANSITION_TABLE_END_YEAR
+    """
+    if ambiguous not in AMBIGUOUS_RULES:
+        raise ValueError("ambiguous must be one of {0}, not {1!r}".format(AMBIGUOUS_RULES, ambiguous))
+    wall_ms = np.asarray(stage_ms, dtype=np.int64)
+    _check_table_range(wall_ms)
+    trans_ms, off_ms, trans_wall_ms = _stage_transitions()
+    idx = np.clip(np.searchsorted(trans_wall_ms, wall_ms, side='right') - 1, 0, None)
+    offset = off_ms[idx]
+    if ambiguous != 'latest':
+        prev_off = off_ms[np.clip(idx - 1, 0, None)]
+        repeated = (idx > 0) & (wall_ms < trans_ms[idx] + prev_off)
+        if ambiguous == 'infer' and repeated.any():
+            # Rank repeated-hour rows by (transition, position in the hour) so a running max finds earlier rows
+            # of the same hour at or past the current wall-clock time
+            pos = np.flatnonzero(repeated.ravel())
+            rank = idx.ravel()[pos] * 2 ** 32 + (wall_ms.ravel()[pos] - trans_wall_ms[idx.ravel()[pos]])
+            seen = np.maximum.accumulate(np.r_[-1, rank[:-1]])
+            second = np.zeros(wall_ms.size, dtype=bool)
+            second[pos] = seen >= rank
+            repeated &= ~second.reshape(wall_ms.shape)
+        offset = np.where(repeated, prev_off, offset)
+    utc_ms = wall_ms - offset
+    return utc_ms[()]
+
 
 def datetime_to_unix(date_str):
     """
-    Function that takes date string formatted "YYYY-mm-dd"; '%Y-%m-%d' in local time and returns UNIX Timestamp
+    Function that takes date string formatted "YYYY-mm-dd"; '%Y-%m-%d' in Mountain time and returns UNIX Timestamp
     :param date_str: string of date formatted "YYYY-mm-dd"
     :return: UNIX Timestamp (seconds from Epoch)
     """
-    dt_naive = datetime.strptime(date_str, "%Y-%m-%d")
-    if dt_naive > datetime(1970, 1, 1):
-        ux_ts = dt_naive.timestamp()
-    else:
-        ux_ts = (dt_naive - datetime(1970, 1, 1)).total_seconds()
-    return int(ux_ts)
+    return int(stage_ms_to_unix(dates_to_stage_ms(date_str)) // 1000)
 
 
 def date_to_unix_naive(date_str):
-    epoch = datetime(1970, 1, 1)
-    dt_naive = datetime.strptime(date_str, "%Y-%m-%d")
-    ux_ts = (dt_naive - epoch).total_seconds()
-    return int(ux_ts)
+    return int(dates_to_stage_ms(date_str) // 1000)
 
 
 def offset_unix(timestamp):
-    tz = pytz.timezone(stage_tz)
-    if timestamp > 0:
-        dt = datetime.utcfromtimestamp(timestamp)
-    else:
-        dt = datetime(1970, 1, 1) + timedelta(seconds=timestamp)
-    dt = pytz.utc.localize(dt)
-    offset = dt.astimezone(tz).utcoffset().total_seconds()
-    ux_off = timestamp + offset
-    return ux_off
+    return unix_to_stage_ms(timestamp) / 1000
 
 ## Depricated
 # def offset_unix(timestamp, utc_offset, units='H'):
@@ -105,3 +234,72 @@ def subset_date_range(start, end, interval, max_size=10000):
     for i in range(interval):
         yield (start + diff * i).strftime("%Y%m%d")
     yield end.strftime("%Y%m%d")
+
+
+MERGE_RULES = ['approval', 'newest', 'oldest']
+
+
+def _merge_runs(keys_a, rows_a, keys_b, rows_b):
+    # Linear merge of two sorted runs; rows from run a stay ahead of run b on equal keys
+    pos_b = np.searchsorted(keys_a, keys_b, side='right') + np.arange(len(keys_b))
+    from_b = np.zeros(len(keys_a) + len(keys_b), dtype=bool)
+    from_b[pos_b] = True
+    keys = np.empty(from_b.size, dtype=keys_a.dtype)
+    rows = np.empty(from_b.size, dtype=np.int64)
+    keys[from_b], keys[~from_b] = keys_b, keys_a
+    rows[from_b], rows[~from_b] = rows_b, rows_a
+    return keys, rows
+
+
+def merge_timeseries(chunks, key='Timestamp', keep='approval', approval_field='ApprovalLevel'):
+    """
+    Merges timeseries chunks (e.g. paged responses or cached pulls) that are each sorted by key into one sorted
+    DataFrame with one row per key. Chunks are merged pairwise with a k-way merge rather than re-sorted; a chunk that
+    is not already sorted is sorted on its own first.
+
+    Rows that share a key are resolved by keep:
+        'approval' - highest approval_field wins, ties (or a missing field) go to the newest chunk
+        'newest' - the row from the latest chunk in chunks wins
+        'oldest' - the row from the earliest chunk in chunks wins
+    :param chunks: list of DataFrames ordered oldest to newest
+    :param key: numeric column to merge on; default is 'Timestamp' (StAGE milliseconds)
+    :param keep: conflict rule, one of MERGE_RULES; default is 'approval'
+    :param approval_field: column ranked by the 'approval' rule; default is 'ApprovalLevel'
+    :return: DataFrame sorted by key with a fresh index
+    """
+    if keep not in MERGE_RULES:
+        raise ValueError("keep must be one of {0}, not {1!r}".format(MERGE_RULES, keep))
+    chunks = [c for c in chunks if len(c) > 0]
+    if not chunks:
+        return pd.DataFrame()
+    combined = pd.concat(chunks, ignore_index=True)
+
+    runs = []
+    first_row = 0
+    for c in chunks:
+        keys = c[key].to_numpy()
+        rows = np.arange(first_row, first_row + len(c))
+        if np.any(keys[1:] < keys[:-1]):
+            order = np.argsort(keys, kind='stable')
+            keys, rows = keys[order], rows[order]
+        runs.append((keys, rows))
+        first_row += len(c)
+    while len(runs) > 1:
+        paired = [_merge_runs(*runs[n], *runs[n + 1]) for n in range(0, len(runs) - 1, 2)]
+        runs = paired + runs[len(paired) * 2:]
+    keys, rows = runs[0]
+
+    # Equal keys are adjacent and ordered oldest to newest chunk
+    is_start = np.r_[True, keys[1:] != keys[:-1]]
+    starts = np.flatnonzero(is_start)
+    if keep == 'oldest':
+        pick = rows[starts]
+    elif keep == 'newest' or approval_field not in combined:
+        pick = rows[np.r_[starts[1:], len(keys)] - 1]
+    else:
+        level = combined[approval_field].to_numpy(dtype=np.float64)[rows]
+        level = np.where(np.isnan(level), -np.inf, level)
+        group = np.cumsum(is_start) - 1
+        best = np.flatnonzero(level == np.maximum.reduceat(level, starts)[group])
+        pick = rows[best[np.r_[group[best][1:] != group[best][:-1], True]]]
+    return combined.iloc[pick].reset_index(drop=True)